@@ -5,14 +5,25 @@
 Минимальный UI + детальный вывод всех ошибок и пропусков.
 """
 
+import functools
 import io
 import json
+import math
 import zipfile
+import os
 import re
+import struct
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Any, Dict, List, Tuple, Optional
-from enum import Enum
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple, Optional
+from enum import StrEnum
+from operator import itemgetter
 
+import numpy as np
+import orjson
 import pandas as pd
 import streamlit as st
 
@@ -22,15 +33,45 @@ import streamlit as st
 DEFAULT_LOCALE = "en-US"
 POG_DIR = "productOfferingGroup"
 POC_DIR = "productOfferingCategory"
+ZIP_COMPRESSLEVEL = 1
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_DATA_DESCRIPTOR_SIGNATURE = 0x08074B50
+ZIP_EXTRA_ZIP64 = 0x0001
+# _copy_member_raw пишет в ZipFile через его внутренности; проверено на CPython 3.11–3.13
+ZIP_RAW_COPY = (3, 11) <= sys.version_info[:2] <= (3, 13)
+OFFERING_ID_KEY = itemgetter("id")
+# Неизменяемые значения, общие для всех собранных POG (orjson пишет tuple как массив)
+PURPOSE_ADDON = ("addOn",)
+PURPOSE_REPLACE = ("replaceOffer",)
+EMPTY_ARRAY = ()
+EMPTY_FRAME = pd.DataFrame()
+CACHE_MAX_ENTRIES = 16
+JSON_WORKERS = min(8, os.cpu_count() or 1)
+JSON_BATCH_SIZE = 64
+PREFILTER_MAX_IDS = 64
+COUNTS_PER_ROW = 4
+EXCEL_TYPES = ("xlsx", "xls", "csv")
+ZIP_TYPES = ("zip",)
+EXCEL_ENGINES = ("calamine", "openpyxl", "xlrd")
+EXCEL_ENGINE_KWARGS: Dict[str, Dict[str, Any]] = {
+    "openpyxl": {"read_only": True, "data_only": True},
+}
+EXCEL_SIGNATURES = (b"PK\x03\x04", b"\xd0\xcf\x11\xe0")  # xlsx (ZIP) и xls (OLE2)
 
 SAFE_NAME_PATTERN = re.compile(r"[^0-9A-Za-z_\-\u0400-\u04FF]")
 WHITESPACE_PATTERN = re.compile(r"\s+")
+# orjson умеет только отступ в 2 пробела; удваиваем его, чтобы формат файлов не менялся
+JSON_INDENT_PATTERN = re.compile(rb"^( +)", re.MULTILINE)
+# Целое вне 64 бит (orjson молча превращает его в float) — это 19+ цифр подряд.
+# Ищем их через translate (все цифры -> "0") и поиск подстроки: это быстрее regex
+DIGITS_TO_ZERO = bytes.maketrans(b"123456789", b"000000000")
+LONG_INT_DIGITS = b"0" * 19
 
 
 # =========================
 # ТИПЫ ПРОБЛЕМ
 # =========================
-class IssueType(Enum):
+class IssueType(StrEnum):
     ALREADY_EXISTS = "already_exists"
     ALREADY_EXPIRED = "already_expired"
     DUPLICATE_IN_SOURCE = "duplicate_in_source"
@@ -43,18 +84,24 @@ class IssueType(Enum):
     MISSING_FIELD = "missing_field"
 
 
-@dataclass
+class Severity(StrEnum):
+    ERROR = "error"
+    WARNING = "warning"
+    INFO = "info"
+
+
+@dataclass(slots=True)
 class Issue:
     """Детальная информация об ошибке или пропуске"""
     type: IssueType
-    severity: str  # "warning", "error", "info"
+    severity: Severity
     message: str
     context: Dict[str, Any] = field(default_factory=dict)
     row_number: Optional[int] = None
     file_path: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class SimpleResult:
     ok: bool
     msg: str
@@ -73,51 +120,126 @@ class SimpleResult:
 def _safe_name(name: str) -> str:
     if not isinstance(name, str):
         name = str(name)
+    return _safe_name_cached(name)
+
+
+@functools.lru_cache(maxsize=4096)
+def _safe_name_cached(name: str) -> str:
     s = WHITESPACE_PATTERN.sub("_", name.strip())
-    s = SAFE_NAME_PATTERN.sub("", s)
+    # Быстрый путь: ASCII-имя только из [0-9A-Za-z_-] уже безопасно
+    if not (s.isascii() and s.replace("_", "").replace("-", "").isalnum()):
+        s = SAFE_NAME_PATTERN.sub("", s)
     return s or "file"
 
 
 def _normalize_str(v: Any) -> str:
-    if pd.isna(v):
-        return ""
-    s = str(v).strip()
-    return "" if s.lower() == "nan" else s
+    # Быстрый путь для строк из JSON: pd.isna для str всегда False
+    if type(v) is not str:
+        if pd.isna(v):
+            return ""
+        v = str(v)
+    s = v.strip()
+    # lower() нужен только для трёхсимвольных строк — остальные не могут быть "nan"
+    return "" if len(s) == 3 and s.lower() == "nan" else s
+
+
+def _normalize_series(s: pd.Series) -> pd.Series:
+    """Векторный аналог _normalize_str для целого столбца.
+    strip/lower идут по Arrow-буферу; на выходе object, т.к. дальше нужны обычные str."""
+    s = s.astype("string[pyarrow]").fillna("").str.strip()
+    return s.mask(s.str.lower() == "nan", "").astype(object)
+
 
+# id нормализуется так же, как строка; псевдоним вместо обёртки — минус вызов на каждый offering
+_normalize_id = _normalize_str
 
-def _normalize_id(v: Any) -> str:
-    s = _normalize_str(v)
-    return s if s else ""
 
+def _index_offerings(offerings: List[Dict[str, Any]], wanted: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Индекс id → offering только для нужных id; проход останавливается, как только
+    все найдены. При повторяющемся id берётся первое вхождение."""
+    wanted = set(wanted)
+    found: Dict[str, Dict[str, Any]] = {}
+    for o in offerings:
+        nid = _normalize_id(o.get("id", ""))
+        if nid in wanted and nid not in found:
+            found[nid] = o
+            if len(found) == len(wanted):
+                break
+    return found
 
-def _json_dumps_stable(obj: Any) -> str:
-    return json.dumps(obj, ensure_ascii=False, indent=4, sort_keys=True)
+
+class _JsonNonFinite(float):
+    """NaN/Infinity из исходного JSON. orjson такие значения не пишет (TypeError),
+    поэтому документ с ними сохраняется через stdlib json без потерь"""
+
+
+def _parse_json_float(s: str) -> float:
+    v = float(s)
+    return v if math.isfinite(v) else _JsonNonFinite(v)
+
+
+def _json_dumps_stable(obj: Any) -> bytes:
+    """UTF-8 байты, готовые к записи в ZIP без повторного кодирования"""
+    try:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+    except TypeError:
+        # Целые вне 64 бит и NaN/Infinity (см. _load_json) умеет только stdlib json
+        return json.dumps(obj, ensure_ascii=False, indent=4, sort_keys=True).encode("utf-8")
+    # Функция вместо шаблона rb"\1\1": шаблон раскрывается в Python на каждой строке
+    return JSON_INDENT_PATTERN.sub(lambda m: m.group(1) * 2, data)
+
+
+def _read_excel(buf: io.BytesIO, usecols: Callable[[Any], bool]) -> pd.DataFrame:
+    """Чтение Excel первым доступным движком (calamine → openpyxl → xlrd)"""
+    # CSV и прочее отсекаем по сигнатуре, не прогоняя файл через все движки
+    if bytes(buf.getbuffer()[:4]) not in EXCEL_SIGNATURES:
+        raise ValueError("Неизвестная сигнатура файла")
+    last_error: Optional[Exception] = None
+    for engine in EXCEL_ENGINES:
+        buf.seek(0)
+        try:
+            return pd.read_excel(
+                buf,
+                engine=engine,
+                dtype=str,
+                usecols=usecols,
+                engine_kwargs=EXCEL_ENGINE_KWARGS.get(engine, {}),
+            )
+        except (ImportError, ValueError) as e:
+            last_error = e
+    raise last_error
 
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
 def _read_table(excel_bytes: bytes, expected_cols: List[str]) -> Tuple[pd.DataFrame, List[Issue]]:
-    """Универсальный ридер с отслеживанием проблем"""
+    """Универсальный ридер с отслеживанием проблем (кэшируется между перезапусками скрипта)"""
     issues = []
     buf = io.BytesIO(excel_bytes)
+    header: List[Any] = []
+
+    def _use_col(col: Any) -> bool:
+        header.append(col)
+        return col in expected_cols
 
     try:
-        df = pd.read_excel(buf, engine="openpyxl")
+        df = _read_excel(buf, _use_col)
     except Exception as e:
         issues.append(Issue(
             type=IssueType.INVALID_JSON,
-            severity="info",
+            severity=Severity.INFO,
             message=f"Не Excel, пробуем CSV: {str(e)[:50]}"
         ))
         buf.seek(0)
         try:
-            df = pd.read_csv(buf)
+            df = pd.read_csv(buf, dtype=str, usecols=_use_col)
         except Exception:
             buf.seek(0)
             try:
-                df = pd.read_csv(buf, sep=";", engine="python")
+                df = pd.read_csv(buf, sep=";", dtype=str, usecols=_use_col)
             except Exception as e2:
                 issues.append(Issue(
                     type=IssueType.INVALID_JSON,
-                    severity="error",
+                    severity=Severity.ERROR,
                     message=f"Не удалось прочитать файл: {str(e2)}"
                 ))
                 raise
@@ -126,62 +248,206 @@ def _read_table(excel_bytes: bytes, expected_cols: List[str]) -> Tuple[pd.DataFr
     if missing:
         issues.append(Issue(
             type=IssueType.MISSING_FIELD,
-            severity="error",
+            severity=Severity.ERROR,
             message=f"Нет столбца(ов): {', '.join(missing)}",
-            context={"missing": missing, "available": list(df.columns)}
+            context={"missing": missing, "available": list(dict.fromkeys(header)) or list(df.columns)}
         ))
         raise KeyError(f"Нет требуемого столбца(ов): {', '.join(missing)}")
 
-    return df[expected_cols].copy(), issues
+    for c in expected_cols:
+        df[c] = _normalize_series(df[c])
+    return df, issues
 
 
 # =========================
 # ZIP/JSON I/O
 # =========================
-def _read_zip(zip_bytes: bytes) -> Tuple[List[str], Dict[str, bytes], List[Issue]]:
+def _read_zip(zip_bytes: bytes) -> Tuple[zipfile.ZipFile, Dict[str, List[str]], List[Issue]]:
+    """Открывает ZIP без распаковки: члены читаются по требованию через src.read().
+    Вместе с архивом возвращается индекс JSON-файлов по каталогу верхнего уровня.
+    Закрывает архив вызывающий код (finally в операции)."""
     issues = []
     try:
-        with zipfile.ZipFile(io.BytesIO(zip_bytes), "r") as zf:
-            names = zf.namelist()
-            content = {n: zf.read(n) for n in names}
-        return names, content, issues
+        src = zipfile.ZipFile(io.BytesIO(zip_bytes), "r")
+        return src, _index_json_by_dir(src.namelist()), issues
     except Exception as e:
         issues.append(Issue(
             type=IssueType.INVALID_JSON,
-            severity="error",
+            severity=Severity.ERROR,
             message=f"Ошибка чтения ZIP: {str(e)}"
         ))
         raise
 
 
-def _list_json_in_dir(bytes_map: Dict[str, bytes], dir_name: str) -> List[str]:
-    prefix = f"{dir_name}/"
-    return [n for n in bytes_map if n.startswith(prefix) and n.endswith(".json")]
+def _index_json_by_dir(names: List[str]) -> Dict[str, List[str]]:
+    by_dir: Dict[str, List[str]] = defaultdict(list)
+    for n in names:
+        top, sep, _ = n.partition("/")
+        if sep and n.endswith(".json"):
+            by_dir[top].append(n)
+    return by_dir
 
 
 def _load_json(data: bytes, path: str, issues: List[Issue]) -> Optional[Dict[str, Any]]:
+    if LONG_INT_DIGITS not in data.translate(DIGITS_TO_ZERO):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    # Медленный путь: большие целые и NaN/Infinity, которые orjson искажает или
+    # отвергает. Если не справится и stdlib json — файл действительно невалиден
     try:
-        return json.loads(data.decode("utf-8"))
+        return json.loads(data.decode("utf-8"), parse_constant=_JsonNonFinite,
+                          parse_float=_parse_json_float)
     except Exception as e:
         issues.append(Issue(
             type=IssueType.INVALID_JSON,
-            severity="error",
-            message=f"Невалидный JSON",
+            severity=Severity.ERROR,
+            message="Невалидный JSON",
             file_path=path,
             context={"error": str(e)[:100]}
         ))
         return None
 
 
-def _build_new_zip(original_names: List[str], original_bytes: Dict[str, bytes],
-                   updated_json_map: Dict[str, str]) -> io.BytesIO:
+def _check_purpose(data: Dict[str, Any], expected: str, path: str, json_id: str,
+                   issues: List[Issue], report_purpose: bool = False) -> bool:
+    """Проверка purpose загруженного POG; при несовпадении добавляет INVALID_TARGET_TYPE.
+    report_purpose — добавить фактический purpose в контекст (как в отчётах операций добавления)"""
+    purpose = data.get("purpose")
+    # то же, что purpose == [expected], но без нового списка на каждый файл
+    if type(purpose) is list and len(purpose) == 1 and purpose[0] == expected:
+        return True
+    issues.append(Issue(
+        type=IssueType.INVALID_TARGET_TYPE,
+        severity=Severity.ERROR,
+        message=f"Неверный purpose (ожидается {expected})",
+        file_path=path,
+        context={"json_id": json_id, "purpose": purpose} if report_purpose else {"json_id": json_id}
+    ))
+    return False
+
+
+def _id_needles(ids: Iterable[str]) -> Optional[Tuple[bytes, ...]]:
+    """Байтовые подстроки для предфильтра _load_jsons; None — id слишком много,
+    перебор подстрок обойдётся дороже самого разбора"""
+    ids = list(ids)
+    if len(ids) > PREFILTER_MAX_IDS:
+        return None
+    return tuple(i.encode("utf-8") for i in ids)
+
+
+def _load_jsons(src: zipfile.ZipFile, paths: List[str], issues: List[Issue],
+                needles: Optional[Tuple[bytes, ...]] = None) -> Iterator[Tuple[str, Optional[Dict[str, Any]]]]:
+    """Распаковка и разбор JSON пачками в пуле потоков; порядок путей и проблем сохраняется.
+    При одном ядре (JSON_WORKERS == 1) пул только мешает, и файлы читаются обычным циклом.
+
+    needles — предфильтр по сырым байтам: файл, где нет ни одной подстроки, не разбирается
+    и отдаётся как None. Такой файл не относится к операции, поэтому и INVALID_JSON для него
+    не сообщается. Файлы с экранированием \\u и \\/ разбираются всегда, т.к. id в них
+    может быть записан не буквально.
+    """
+    def _load_one(path: str) -> Tuple[Optional[Dict[str, Any]], List[Issue]]:
+        load_issues: List[Issue] = []
+        raw = src.read(path)
+        if (needles is not None and b"\\u" not in raw and b"\\/" not in raw
+                and not any(n in raw for n in needles)):
+            return None, load_issues
+        return _load_json(raw, path, load_issues), load_issues
+
+    if JSON_WORKERS == 1:
+        for path in paths:
+            data, load_issues = _load_one(path)
+            issues.extend(load_issues)
+            yield path, data
+        return
+
+    with ThreadPoolExecutor(max_workers=JSON_WORKERS) as pool:
+        for i in range(0, len(paths), JSON_BATCH_SIZE):
+            batch = paths[i:i + JSON_BATCH_SIZE]
+            for path, (data, load_issues) in zip(batch, pool.map(_load_one, batch)):
+                issues.extend(load_issues)
+                yield path, data
+
+
+def _zip_extra_without_zip64(extra: bytes) -> bytes:
+    """Extra-поля члена без zip64 (id 0x0001): его FileHeader() добавит сам, если нужно"""
+    out = []
+    i = 0
+    while i + 4 <= len(extra):
+        tp, ln = struct.unpack("<HH", extra[i:i + 4])
+        if tp != ZIP_EXTRA_ZIP64:
+            out.append(extra[i:i + 4 + ln])
+        i += 4 + ln
+    return b"".join(out)
+
+
+def _copy_member_raw(src: zipfile.ZipFile, info: zipfile.ZipInfo, zf: zipfile.ZipFile) -> None:
+    """Переносит член ZIP без распаковки и повторного сжатия (в том числе зашифрованный).
+
+    У zipfile нет публичного API для копирования сжатых данных, поэтому здесь
+    повторяется то, что делает ZipFile.writestr, но с готовыми байтами. Это опирается
+    на внутренности zipfile, так что на непроверенных версиях Python (ZIP_RAW_COPY)
+    член просто распаковывается и сжимается заново.
+    """
+    out = zipfile.ZipInfo(info.filename, info.date_time)
+    out.compress_type = info.compress_type
+    out.create_system = info.create_system
+    out.external_attr = info.external_attr
+    out.extra = _zip_extra_without_zip64(info.extra)
+    out.comment = info.comment
+    out.flag_bits = info.flag_bits
+
+    if not ZIP_RAW_COPY:
+        zf.writestr(out, src.read(info), compresslevel=ZIP_COMPRESSLEVEL)
+        return
+
+    with src._lock:
+        src.fp.seek(info.header_offset)
+        fheader = struct.unpack(zipfile.structFileHeader, src.fp.read(zipfile.sizeFileHeader))
+        src.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        raw = src.fp.read(info.compress_size)
+
+    out.CRC = info.CRC
+    out.compress_size = info.compress_size
+    out.file_size = info.file_size
+    zip64 = out.file_size > zipfile.ZIP64_LIMIT or out.compress_size > zipfile.ZIP64_LIMIT
+
+    zf._writecheck(out)
+    zf._didModify = True
+    out.header_offset = zf.fp.tell()
+    zf.fp.write(out.FileHeader(zip64))
+    zf.fp.write(raw)
+    if out.flag_bits & ZIP_FLAG_DATA_DESCRIPTOR:
+        # Флаги (и проверка пароля для шифрованных членов) сохраняются как были,
+        # поэтому data descriptor тоже пишется, как в исходнике
+        fmt = "<LLQQ" if zip64 else "<LLLL"
+        zf.fp.write(struct.pack(fmt, ZIP_DATA_DESCRIPTOR_SIGNATURE, out.CRC, out.compress_size, out.file_size))
+    zf.start_dir = zf.fp.tell()
+    zf.filelist.append(out)
+    zf.NameToInfo[out.filename] = out
+
+
+def _writestr(zf: zipfile.ZipFile, name: str, data: bytes, date_time: Tuple[int, ...]) -> None:
+    """Аналог ZipFile.writestr по имени, но метка времени берётся одна на весь архив,
+    а не вычисляется через time.localtime() для каждого члена"""
+    info = zipfile.ZipInfo(name, date_time)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o600 << 16
+    zf.writestr(info, data, compresslevel=ZIP_COMPRESSLEVEL)
+
+
+def _build_new_zip(src: zipfile.ZipFile, updated_json_map: Dict[str, bytes]) -> io.BytesIO:
+    """Изменённые JSON сжимаются заново, остальные члены копируются как есть"""
     buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-        for name in original_names:
+    stamp = time.localtime()[:6]
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zf:
+        for info in src.infolist():
+            name = info.filename
             if name in updated_json_map:
-                zf.writestr(name, updated_json_map[name].encode("utf-8"))
+                _writestr(zf, name, updated_json_map[name], stamp)
             else:
-                zf.writestr(name, original_bytes[name])
+                _copy_member_raw(src, info, zf)
     buf.seek(0)
     return buf
 
@@ -189,51 +455,60 @@ def _build_new_zip(original_names: List[str], original_bytes: Dict[str, bytes],
 # =========================
 # BUILDERS
 # =========================
+@functools.lru_cache(maxsize=4096)
+def _localized(locale: str, value: str) -> Tuple[Dict[str, str], ...]:
+    """Кэшируется: результат общий для всех POG, изменять его нельзя"""
+    return ({"locale": locale, "value": value},)
+
+
 def _make_offering(offer_id: str, name: Optional[str] = None,
                    locale: str = DEFAULT_LOCALE, expired: bool = False) -> Dict[str, Any]:
+    """name берётся из кэша _localized: одна и та же услуга в разных POG не создаёт
+    новых вложенных объектов"""
     item: Dict[str, Any] = {
         "id": offer_id,
         "isBundle": False,
         "expiredForSales": expired
     }
     if name:
-        item["name"] = [{"locale": locale, "value": name}]
+        item["name"] = _localized(locale, name)
     return item
 
 
 def _build_pog_addon(json_name: str, json_id: str, locale: str,
-                     offerings: List[Dict[str, Any]]) -> Dict[str, Any]:
+                     offerings: List[Dict[str, Any]], pre_sorted: bool = False) -> Dict[str, Any]:
     return {
         "effective": True,
-        "externalId": [],
+        "externalId": EMPTY_ARRAY,
         "id": json_id,
-        "localizedName": [{"locale": locale, "value": json_name}],
+        "localizedName": _localized(locale, json_name),
         "name": _safe_name(json_name),
-        "policy": [],
-        "productOfferingsInGroup": sorted(offerings, key=lambda x: x["id"]),
-        "purpose": ["addOn"],
-        "restriction": []
+        "policy": EMPTY_ARRAY,
+        "productOfferingsInGroup": offerings if pre_sorted else sorted(offerings, key=OFFERING_ID_KEY),
+        "purpose": PURPOSE_ADDON,
+        "restriction": EMPTY_ARRAY
     }
 
 
 def _build_pog_replace(json_name: str, json_id: str, locale: str,
-                       offerings: List[Dict[str, Any]]) -> Dict[str, Any]:
+                       offerings: List[Dict[str, Any]], pre_sorted: bool = False) -> Dict[str, Any]:
     return {
-        "description": [{"locale": locale, "value": json_name}],
+        "description": _localized(locale, json_name),
         "effective": True,
-        "externalId": [],
+        "externalId": EMPTY_ARRAY,
         "id": json_id,
-        "localizedName": [{"locale": locale, "value": json_name}],
+        "localizedName": _localized(locale, json_name),
         "name": _safe_name(json_name),
-        "policy": [],
-        "productOfferingsInGroup": sorted(offerings, key=lambda x: x["id"]),
-        "purpose": ["replaceOffer"],
-        "restriction": []
+        "policy": EMPTY_ARRAY,
+        "productOfferingsInGroup": offerings if pre_sorted else sorted(offerings, key=OFFERING_ID_KEY),
+        "purpose": PURPOSE_REPLACE,
+        "restriction": EMPTY_ARRAY
     }
 
 
 def _build_category(offer_id: str, category_ids: List[str]) -> Dict[str, Any]:
-    unique_sorted = sorted({cid for cid in (_normalize_id(c) for c in category_ids) if cid})
+    """category_ids — уже нормализованные непустые значения (см. _read_table)"""
+    unique_sorted = sorted(set(category_ids))
     return {
         "id": offer_id,
         "category": unique_sorted,
@@ -244,6 +519,31 @@ def _build_category(offer_id: str, category_ids: List[str]) -> Dict[str, Any]:
 # =========================
 # ОПЕРАЦИИ
 # =========================
+# Операции кэшируются через st.cache_data по входным байтам: повторный запуск с теми же
+# файлами отдаёт копию готового SimpleResult без повторного разбора Excel и ZIP.
+EmptyCheck = Tuple[str, str, Optional[Tuple[str, str]]]  # (столбец, сообщение, (ключ контекста, столбец))
+
+
+def _report_empty_ids(result: SimpleResult, df: pd.DataFrame, checks: List[EmptyCheck]) -> np.ndarray:
+    """Предупреждения о пустых ID по маскам столбцов — без построчного iterrows.
+    Порядок как при обходе по строкам: строка за строкой, внутри строки — по checks.
+    Возвращает маску валидных строк (все проверяемые столбцы непустые) для фильтрации df."""
+    masks = [df[col].to_numpy() == "" for col, _, _ in checks]
+    empty = np.logical_or.reduce(masks)
+    rows = np.flatnonzero(empty)
+    if rows.size:
+        ctx_values = [df[ctx[1]].to_numpy() if ctx else None for _, _, ctx in checks]
+        result.issues.extend([
+            Issue(IssueType.EMPTY_ID, Severity.WARNING, message,
+                  {ctx[0]: values[i]} if ctx else {}, i + 2)
+            for i in rows.tolist()
+            for mask, (_, message, ctx), values in zip(masks, checks, ctx_values)
+            if mask[i]
+        ])
+    return ~empty
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
 def generate_addon_from_excel(excel_bytes: bytes) -> SimpleResult:
     """1. Доступность услуги для некоторых тарифных планов."""
     result = SimpleResult(False, "", None, {})
@@ -253,31 +553,15 @@ def generate_addon_from_excel(excel_bytes: bytes) -> SimpleResult:
         df, read_issues = _read_table(excel_bytes, expected)
         result.issues.extend(read_issues)
         
-        for c in expected:
-            df[c] = df[c].apply(_normalize_str)
-        
         total_rows = len(df)
         
         # Отслеживание пустых ID
-        for idx, row in df.iterrows():
-            if not row["Addons ID"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой Addons ID",
-                    row_number=idx + 2,
-                    context={"addons_name": row["Addons name"]}
-                ))
-            if not row["ID услуги"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой ID услуги",
-                    row_number=idx + 2,
-                    context={"service_name": row["Имя услуги"]}
-                ))
+        valid = _report_empty_ids(result, df, [
+            ("Addons ID", "Пустой Addons ID", ("addons_name", "Addons name")),
+            ("ID услуги", "Пустой ID услуги", ("service_name", "Имя услуги")),
+        ])
         
-        df = df[(df["Addons ID"] != "") & (df["ID услуги"] != "")]
+        df = df[valid]
         
         if df.empty:
             result.msg = "В Excel нет валидных строк"
@@ -287,38 +571,43 @@ def generate_addon_from_excel(excel_bytes: bytes) -> SimpleResult:
         result.counts["valid_rows"] = len(df)
         result.counts["skipped_rows"] = total_rows - len(df)
         
-        groups = df.groupby(["Addons name", "Addons ID"])
+        # Одна сортировка по (группа, ID услуги): группы идут подряд в порядке groupby,
+        # внутри группы услуги уже отсортированы, дубликаты помечаются маской
+        key_cols = ["Addons name", "Addons ID", "ID услуги"]
+        df = df.sort_values(key_cols, kind="stable")
+        dup = df.duplicated(subset=key_cols).to_numpy()
+        names = df["Addons name"].to_numpy()
+        addon_ids = df["Addons ID"].to_numpy()
+        starts = np.flatnonzero(np.r_[True, (names[1:] != names[:-1]) | (addon_ids[1:] != addon_ids[:-1])])
+        ends = np.r_[starts[1:], len(df)]
+        dup_counts = np.add.reduceat(dup, starts)
+        sids = df["ID услуги"].tolist()
+        snames = df["Имя услуги"].tolist()
+        keep = (~dup).tolist()
         buf = io.BytesIO()
         created_jsons = 0
         services_total = 0
         
-        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-            for (json_name, json_id), g in groups:
-                initial_count = len(g)
-                g = g.drop_duplicates(subset=["ID услуги"])
-                duplicates_count = initial_count - len(g)
+        stamp = time.localtime()[:6]
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zf:
+            for start, end, duplicates_count in zip(starts.tolist(), ends.tolist(), dup_counts.tolist()):
+                json_name, json_id = names[start], addon_ids[start]
                 
                 if duplicates_count > 0:
                     result.add_issue(Issue(
                         type=IssueType.DUPLICATE_IN_SOURCE,
-                        severity="info",
+                        severity=Severity.INFO,
                         message=f"Удалено дубликатов: {duplicates_count}",
                         context={"addons_id": json_id, "addons_name": json_name}
                     ))
                 
-                offerings = []
-                for _, r in g.iterrows():
-                    sid = _normalize_id(r["ID услуги"])
-                    sname = _normalize_str(r["Имя услуги"])
-                    if not sid:
-                        continue
-                    offerings.append(_make_offering(sid, sname, DEFAULT_LOCALE))
-                
-                if not offerings:
-                    continue
+                offerings = [
+                    _make_offering(sids[i], snames[i], DEFAULT_LOCALE)
+                    for i in range(start, end) if keep[i]
+                ]
                 
-                pog = _build_pog_addon(_normalize_str(json_name), _normalize_id(json_id), DEFAULT_LOCALE, offerings)
-                zf.writestr(f"{POG_DIR}/{_safe_name(json_id)}.json", _json_dumps_stable(pog))
+                pog = _build_pog_addon(json_name, json_id, DEFAULT_LOCALE, offerings, pre_sorted=True)
+                _writestr(zf, f"{POG_DIR}/{_safe_name(json_id)}.json", _json_dumps_stable(pog), stamp)
                 created_jsons += 1
                 services_total += len(offerings)
         
@@ -336,7 +625,7 @@ def generate_addon_from_excel(excel_bytes: bytes) -> SimpleResult:
     except Exception as e:
         result.add_issue(Issue(
             type=IssueType.INVALID_JSON,
-            severity="error",
+            severity=Severity.ERROR,
             message=f"Критическая ошибка: {str(e)}"
         ))
         result.msg = f"Ошибка: {e}"
@@ -344,15 +633,17 @@ def generate_addon_from_excel(excel_bytes: bytes) -> SimpleResult:
     return result
 
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
 def add_services_to_existing_pogs(zip_bytes: bytes, excel_bytes: bytes) -> SimpleResult:
     """2. Добавление услуги в существующие планы."""
     result = SimpleResult(False, "", None, {})
+    src: Optional[zipfile.ZipFile] = None
     
     try:
-        names, blob, zip_issues = _read_zip(zip_bytes)
+        src, json_by_dir, zip_issues = _read_zip(zip_bytes)
         result.issues.extend(zip_issues)
         
-        json_files = _list_json_in_dir(blob, POG_DIR)
+        json_files = json_by_dir.get(POG_DIR, [])
         if not json_files:
             result.msg = f"В ZIP нет JSON в {POG_DIR}/"
             return result
@@ -365,38 +656,26 @@ def add_services_to_existing_pogs(zip_bytes: bytes, excel_bytes: bytes) -> Simpl
         
         total_rows = len(df)
         
-        for c in expected:
-            df[c] = df[c].apply(_normalize_str)
-        
-        for idx, row in df.iterrows():
-            if not row["Addons ID"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой Addons ID",
-                    row_number=idx + 2
-                ))
-            if not row["ID услуги"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой ID услуги",
-                    row_number=idx + 2
-                ))
+        valid = _report_empty_ids(result, df, [
+            ("Addons ID", "Пустой Addons ID", None),
+            ("ID услуги", "Пустой ID услуги", None),
+        ])
         
-        df = df[(df["Addons ID"] != "") & (df["ID услуги"] != "")]
+        df = df[valid]
         
         result.counts["total_rows"] = total_rows
         result.counts["valid_rows"] = len(df)
         
-        service_map = df.groupby("Addons ID")[["Имя услуги", "ID услуги"]].apply(lambda x: x.to_dict("records")).to_dict()
+        service_map: Dict[str, List[Tuple[str, str]]] = defaultdict(list)  # Addons ID → [(ID услуги, имя)]
+        for aid, sname, sid in zip(df["Addons ID"].tolist(), df["Имя услуги"].tolist(), df["ID услуги"].tolist()):
+            service_map[aid].append((sid, sname))
         
-        updated: Dict[str, str] = {}
+        updated: Dict[str, bytes] = {}
         found_ids = set()
+        already_exists = 0
         skipped_rows: List[Dict[str, str]] = []
         
-        for path in json_files:
-            data = _load_json(blob[path], path, result.issues)
+        for path, data in _load_jsons(src, json_files, result.issues):
             if not data:
                 continue
             
@@ -404,7 +683,7 @@ def add_services_to_existing_pogs(zip_bytes: bytes, excel_bytes: bytes) -> Simpl
             if not json_id:
                 result.add_issue(Issue(
                     type=IssueType.EMPTY_ID,
-                    severity="error",
+                    severity=Severity.ERROR,
                     message="JSON без ID",
                     file_path=path
                 ))
@@ -415,31 +694,20 @@ def add_services_to_existing_pogs(zip_bytes: bytes, excel_bytes: bytes) -> Simpl
             
             found_ids.add(json_id)
             
-            if data.get("purpose") != ["addOn"]:
-                result.add_issue(Issue(
-                    type=IssueType.INVALID_TARGET_TYPE,
-                    severity="error",
-                    message=f"Неверный purpose (ожидается addOn)",
-                    file_path=path,
-                    context={"json_id": json_id, "purpose": data.get("purpose")}
-                ))
+            if not _check_purpose(data, "addOn", path, json_id, result.issues, report_purpose=True):
                 continue
             
             offerings = data.get("productOfferingsInGroup", [])
             existing = {_normalize_id(o.get("id", "")) for o in offerings}
             
             modified = False
-            for rec in service_map[json_id]:
-                sid = _normalize_id(rec["ID услуги"])
-                sname = _normalize_str(rec["Имя услуги"])
-                if not sid:
-                    continue
-                
+            for sid, sname in service_map[json_id]:
                 if sid in existing:
+                    already_exists += 1
                     result.add_issue(Issue(
                         type=IssueType.ALREADY_EXISTS,
-                        severity="info",
-                        message=f"Услуга уже существует",
+                        severity=Severity.INFO,
+                        message="Услуга уже существует",
                         file_path=path,
                         context={"json_id": json_id, "service_id": sid, "service_name": sname}
                     ))
@@ -455,29 +723,30 @@ def add_services_to_existing_pogs(zip_bytes: bytes, excel_bytes: bytes) -> Simpl
                     modified = True
             
             if modified:
-                data["productOfferingsInGroup"] = sorted(offerings, key=lambda x: x["id"])
+                offerings.sort(key=OFFERING_ID_KEY)
+                data["productOfferingsInGroup"] = offerings
                 updated[path] = _json_dumps_stable(data)
         
-        for want_id in service_map.keys():
+        for want_id in sorted(service_map):  # порядок как у прежнего groupby
             if want_id not in found_ids:
                 result.add_issue(Issue(
                     type=IssueType.NOT_FOUND_JSON_ID,
-                    severity="error",
-                    message=f"JSON файл не найден",
+                    severity=Severity.ERROR,
+                    message="JSON файл не найден",
                     context={"addons_id": want_id}
                 ))
         
         result.counts["files_processed"] = len(updated)
-        result.counts["added"] = sum(1 for i in result.issues if i.type == IssueType.ALREADY_EXISTS)
+        result.counts["added"] = already_exists
         result.counts["skipped_existing"] = len(skipped_rows)
-        result.details = {"skipped_existing": skipped_rows}
+        result.details = {"skipped_existing": pd.DataFrame(skipped_rows)}
         
         if not updated:
             result.ok = True
             result.msg = "Нет изменений"
             return result
         
-        buf = _build_new_zip(names, blob, updated)
+        buf = _build_new_zip(src, updated)
         result.ok = True
         result.msg = "Готово"
         result.zip_data = buf
@@ -485,23 +754,28 @@ def add_services_to_existing_pogs(zip_bytes: bytes, excel_bytes: bytes) -> Simpl
     except Exception as e:
         result.add_issue(Issue(
             type=IssueType.INVALID_JSON,
-            severity="error",
+            severity=Severity.ERROR,
             message=f"Критическая ошибка: {str(e)}"
         ))
         result.msg = f"Ошибка: {e}"
+    finally:
+        if src is not None:
+            src.close()
     
     return result
 
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
 def expire_services_in_pogs(zip_bytes: bytes, excel_bytes: bytes) -> SimpleResult:
     """3. Экспайр услуги."""
     result = SimpleResult(False, "", None, {})
+    src: Optional[zipfile.ZipFile] = None
     
     try:
-        names, blob, zip_issues = _read_zip(zip_bytes)
+        src, json_by_dir, zip_issues = _read_zip(zip_bytes)
         result.issues.extend(zip_issues)
         
-        json_files = _list_json_in_dir(blob, POG_DIR)
+        json_files = json_by_dir.get(POG_DIR, [])
         if not json_files:
             result.msg = f"В ZIP нет JSON в {POG_DIR}/"
             return result
@@ -513,37 +787,25 @@ def expire_services_in_pogs(zip_bytes: bytes, excel_bytes: bytes) -> SimpleResul
         
         total_rows = len(df)
         
-        for c in ["json_id", "service_id"]:
-            df[c] = df[c].apply(_normalize_str)
-        
-        for idx, row in df.iterrows():
-            if not row["json_id"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой json_id",
-                    row_number=idx + 2
-                ))
-            if not row["service_id"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой service_id",
-                    row_number=idx + 2
-                ))
+        valid = _report_empty_ids(result, df, [
+            ("json_id", "Пустой json_id", None),
+            ("service_id", "Пустой service_id", None),
+        ])
         
-        df = df[(df["json_id"] != "") & (df["service_id"] != "")]
+        df = df[valid]
         
         result.counts["total_rows"] = total_rows
         result.counts["valid_rows"] = len(df)
         
-        expire_map = df.groupby("json_id")["service_id"].apply(list).to_dict()
+        expire_map: Dict[str, List[str]] = defaultdict(list)
+        for jid, sid in zip(df["json_id"].tolist(), df["service_id"].tolist()):
+            expire_map[jid].append(sid)
         
-        updated: Dict[str, str] = {}
+        updated: Dict[str, bytes] = {}
         found_ids = set()
+        already_expired = 0
         
-        for path in json_files:
-            data = _load_json(blob[path], path, result.issues)
+        for path, data in _load_jsons(src, json_files, result.issues, _id_needles(expire_map)):
             if not data:
                 continue
             
@@ -553,28 +815,20 @@ def expire_services_in_pogs(zip_bytes: bytes, excel_bytes: bytes) -> SimpleResul
             
             found_ids.add(json_id)
             
-            if data.get("purpose") != ["addOn"]:
-                result.add_issue(Issue(
-                    type=IssueType.INVALID_TARGET_TYPE,
-                    severity="error",
-                    message=f"Неверный purpose (ожидается addOn)",
-                    file_path=path,
-                    context={"json_id": json_id}
-                ))
+            if not _check_purpose(data, "addOn", path, json_id, result.issues):
                 continue
             
             offerings = data.get("productOfferingsInGroup", [])
-            index_by_id = {_normalize_id(o.get("id", "")): o for o in offerings}
+            index_by_id = _index_offerings(offerings, expire_map[json_id])
             
             modified = False
             for sid in expire_map[json_id]:
-                sid = _normalize_id(sid)
                 o = index_by_id.get(sid)
                 if o is None:
                     result.add_issue(Issue(
                         type=IssueType.NOT_FOUND_SERVICE_ID,
-                        severity="error",
-                        message=f"Услуга не найдена",
+                        severity=Severity.ERROR,
+                        message="Услуга не найдена",
                         file_path=path,
                         context={"json_id": json_id, "service_id": sid}
                     ))
@@ -584,36 +838,38 @@ def expire_services_in_pogs(zip_bytes: bytes, excel_bytes: bytes) -> SimpleResul
                     o["expiredForSales"] = True
                     modified = True
                 else:
+                    already_expired += 1
                     result.add_issue(Issue(
                         type=IssueType.ALREADY_EXPIRED,
-                        severity="info",
-                        message=f"Услуга уже экспайрнута",
+                        severity=Severity.INFO,
+                        message="Услуга уже экспайрнута",
                         file_path=path,
                         context={"json_id": json_id, "service_id": sid}
                     ))
             
             if modified:
-                data["productOfferingsInGroup"] = sorted(offerings, key=lambda x: x["id"])
+                offerings.sort(key=OFFERING_ID_KEY)
+                data["productOfferingsInGroup"] = offerings
                 updated[path] = _json_dumps_stable(data)
         
-        for want_id in expire_map.keys():
+        for want_id in sorted(expire_map):  # порядок как у прежнего groupby
             if want_id not in found_ids:
                 result.add_issue(Issue(
                     type=IssueType.NOT_FOUND_JSON_ID,
-                    severity="error",
-                    message=f"JSON файл не найден",
+                    severity=Severity.ERROR,
+                    message="JSON файл не найден",
                     context={"json_id": want_id}
                 ))
         
         result.counts["files_processed"] = len(updated)
-        result.counts["expired"] = sum(1 for i in result.issues if i.type == IssueType.ALREADY_EXPIRED)
+        result.counts["expired"] = already_expired
         
         if not updated:
             result.ok = True
             result.msg = "Нет изменений"
             return result
         
-        buf = _build_new_zip(names, blob, updated)
+        buf = _build_new_zip(src, updated)
         result.ok = True
         result.msg = "Готово"
         result.zip_data = buf
@@ -621,24 +877,29 @@ def expire_services_in_pogs(zip_bytes: bytes, excel_bytes: bytes) -> SimpleResul
     except Exception as e:
         result.add_issue(Issue(
             type=IssueType.INVALID_JSON,
-            severity="error",
+            severity=Severity.ERROR,
             message=f"Критическая ошибка: {str(e)}"
         ))
         result.msg = f"Ошибка: {e}"
+    finally:
+        if src is not None:
+            src.close()
     
     return result
 
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
 def expire_and_add_services(zip_bytes: bytes, expire_excel: bytes, add_excel: bytes) -> SimpleResult:
     """4. Экспайр + Добавление услуги (две независимые операции)."""
     result = SimpleResult(False, "", None, {})
+    src: Optional[zipfile.ZipFile] = None
     
     try:
         # Читаем ZIP
-        names, blob, zip_issues = _read_zip(zip_bytes)
+        src, json_by_dir, zip_issues = _read_zip(zip_bytes)
         result.issues.extend(zip_issues)
         
-        json_files = _list_json_in_dir(blob, POG_DIR)
+        json_files = json_by_dir.get(POG_DIR, [])
         if not json_files:
             result.msg = f"В ZIP нет JSON в {POG_DIR}/"
             return result
@@ -651,25 +912,15 @@ def expire_and_add_services(zip_bytes: bytes, expire_excel: bytes, add_excel: by
         
         total_expire_rows = len(df_expire)
         
-        for c in ["ID услуги", "Имя услуги"]:
-            df_expire[c] = df_expire[c].apply(_normalize_str)
+        valid = _report_empty_ids(result, df_expire, [("ID услуги", "Пустой ID услуги для экспайра", None)])
         
-        for idx, row in df_expire.iterrows():
-            if not row["ID услуги"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой ID услуги для экспайра",
-                    row_number=idx + 2
-                ))
-        
-        df_expire = df_expire[df_expire["ID услуги"] != ""]
+        df_expire = df_expire[valid]
         
         result.counts["expire_total_rows"] = total_expire_rows
         result.counts["expire_valid_rows"] = len(df_expire)
         
         # Создаем set для быстрого поиска
-        services_to_expire = {_normalize_id(row["ID услуги"]) for _, row in df_expire.iterrows()}
+        services_to_expire = set(df_expire["ID услуги"].tolist())
         
         # === ЭТАП 2: Читаем файл для добавления ===
         df_add, add_issues = _read_table(add_excel, ["ID услуги", "Имя услуги"])
@@ -677,95 +928,80 @@ def expire_and_add_services(zip_bytes: bytes, expire_excel: bytes, add_excel: by
         
         total_add_rows = len(df_add)
         
-        for c in ["ID услуги", "Имя услуги"]:
-            df_add[c] = df_add[c].apply(_normalize_str)
-        
-        for idx, row in df_add.iterrows():
-            if not row["ID услуги"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой ID услуги для добавления",
-                    row_number=idx + 2
-                ))
+        valid = _report_empty_ids(result, df_add, [("ID услуги", "Пустой ID услуги для добавления", None)])
         
-        df_add = df_add[df_add["ID услуги"] != ""]
+        df_add = df_add[valid]
         
         result.counts["add_total_rows"] = total_add_rows
         result.counts["add_valid_rows"] = len(df_add)
         
         # Проверка на пересечение (warning)
-        services_to_add_ids = {_normalize_id(row["ID услуги"]) for _, row in df_add.iterrows()}
+        add_ids = df_add["ID услуги"].tolist()
+        services_to_add_ids = set(add_ids)
         overlap = services_to_expire & services_to_add_ids
         if overlap:
             result.add_issue(Issue(
                 type=IssueType.DUPLICATE_IN_SOURCE,
-                severity="warning",
+                severity=Severity.WARNING,
                 message=f"Услуги присутствуют в обоих файлах: {', '.join(list(overlap)[:5])}",
                 context={"overlap_count": len(overlap)}
             ))
         
         # Создаем список услуг для добавления с именами
-        services_to_add = []
-        for _, row in df_add.iterrows():
-            sid = _normalize_id(row["ID услуги"])
-            sname = _normalize_str(row["Имя услуги"])
-            if sid:
-                services_to_add.append({"id": sid, "name": sname})
+        services_to_add = [{"id": sid, "name": sname} for sid, sname in zip(add_ids, df_add["Имя услуги"].tolist())]
         
         # === ЭТАП 3: Обработка JSON файлов ===
-        updated: Dict[str, str] = {}
+        updated: Dict[str, bytes] = {}
         expired_count = 0
         added_count = 0
         skipped_expire_not_found = []
         skipped_add_existing = []
+        found_expired = set()
         
-        for path in json_files:
-            data = _load_json(blob[path], path, result.issues)
+        for path, data in _load_jsons(src, json_files, result.issues):
             if not data:
                 continue
             
+            # Поиск услуг для экспайра идёт по всем JSON, включая пропущенные ниже,
+            # поэтому отмечаем найденные до проверок — без второго прохода по ZIP
+            offerings = data.get("productOfferingsInGroup", [])
+            norm_ids = [_normalize_id(o.get("id", "")) for o in offerings]
+            existing_ids = set(norm_ids)
+            to_expire = services_to_expire & existing_ids
+            found_expired.update(to_expire)
+            
             json_id = _normalize_id(data.get("id", ""))
             if not json_id:
                 result.add_issue(Issue(
                     type=IssueType.EMPTY_ID,
-                    severity="error",
+                    severity=Severity.ERROR,
                     message="JSON без ID",
                     file_path=path
                 ))
                 continue
             
             # Проверяем purpose
-            if data.get("purpose") != ["addOn"]:
-                result.add_issue(Issue(
-                    type=IssueType.INVALID_TARGET_TYPE,
-                    severity="error",
-                    message=f"Неверный purpose (ожидается addOn)",
-                    file_path=path,
-                    context={"json_id": json_id, "purpose": data.get("purpose")}
-                ))
+            if not _check_purpose(data, "addOn", path, json_id, result.issues, report_purpose=True):
                 continue
             
-            offerings = data.get("productOfferingsInGroup", [])
-            existing_ids = {_normalize_id(o.get("id", "")) for o in offerings}
             modified = False
             
-            # --- Операция 1: Экспайр ---
-            for offering in offerings:
-                sid = _normalize_id(offering.get("id", ""))
-                if sid in services_to_expire:
-                    if not offering.get("expiredForSales", False):
-                        offering["expiredForSales"] = True
-                        expired_count += 1
-                        modified = True
-                    else:
-                        result.add_issue(Issue(
-                            type=IssueType.ALREADY_EXPIRED,
-                            severity="info",
-                            message=f"Услуга уже экспайрнута",
-                            file_path=path,
-                            context={"json_id": json_id, "service_id": sid}
-                        ))
+            # --- Операция 1: Экспайр (проход по offerings только при совпадениях) ---
+            if to_expire:
+                for sid, offering in zip(norm_ids, offerings):
+                    if sid in to_expire:
+                        if not offering.get("expiredForSales", False):
+                            offering["expiredForSales"] = True
+                            expired_count += 1
+                            modified = True
+                        else:
+                            result.add_issue(Issue(
+                                type=IssueType.ALREADY_EXPIRED,
+                                severity=Severity.INFO,
+                                message="Услуга уже экспайрнута",
+                                file_path=path,
+                                context={"json_id": json_id, "service_id": sid}
+                            ))
             
             # --- Операция 2: Добавление ---
             for service in services_to_add:
@@ -781,8 +1017,8 @@ def expire_and_add_services(zip_bytes: bytes, expire_excel: bytes, add_excel: by
                     })
                     result.add_issue(Issue(
                         type=IssueType.ALREADY_EXISTS,
-                        severity="info",
-                        message=f"Услуга уже существует",
+                        severity=Severity.INFO,
+                        message="Услуга уже существует",
                         file_path=path,
                         context={"json_id": json_id, "service_id": sid, "service_name": sname}
                     ))
@@ -794,20 +1030,11 @@ def expire_and_add_services(zip_bytes: bytes, expire_excel: bytes, add_excel: by
             
             # Сохраняем изменения
             if modified:
-                data["productOfferingsInGroup"] = sorted(offerings, key=lambda x: x["id"])
+                offerings.sort(key=OFFERING_ID_KEY)
+                data["productOfferingsInGroup"] = offerings
                 updated[path] = _json_dumps_stable(data)
         
         # Проверяем, какие услуги для экспайра не были найдены
-        found_expired = set()
-        for path in json_files:
-            data = _load_json(blob[path], path, [])
-            if data:
-                offerings = data.get("productOfferingsInGroup", [])
-                for o in offerings:
-                    sid = _normalize_id(o.get("id", ""))
-                    if sid in services_to_expire:
-                        found_expired.add(sid)
-        
         not_found_expire = services_to_expire - found_expired
         for sid in not_found_expire:
             skipped_expire_not_found.append({
@@ -816,8 +1043,8 @@ def expire_and_add_services(zip_bytes: bytes, expire_excel: bytes, add_excel: by
             })
             result.add_issue(Issue(
                 type=IssueType.NOT_FOUND_SERVICE_ID,
-                severity="info",
-                message=f"Услуга для экспайра не найдена ни в одном JSON",
+                severity=Severity.INFO,
+                message="Услуга для экспайра не найдена ни в одном JSON",
                 context={"service_id": sid}
             ))
         
@@ -829,8 +1056,8 @@ def expire_and_add_services(zip_bytes: bytes, expire_excel: bytes, add_excel: by
         result.counts["skipped_add_existing"] = len(skipped_add_existing)
         
         result.details = {
-            "skipped_expire_not_found": skipped_expire_not_found,
-            "skipped_add_existing": skipped_add_existing
+            "skipped_expire_not_found": pd.DataFrame(skipped_expire_not_found),
+            "skipped_add_existing": pd.DataFrame(skipped_add_existing)
         }
         
         if not updated:
@@ -838,7 +1065,7 @@ def expire_and_add_services(zip_bytes: bytes, expire_excel: bytes, add_excel: by
             result.msg = "Нет изменений"
             return result
         
-        buf = _build_new_zip(names, blob, updated)
+        buf = _build_new_zip(src, updated)
         result.ok = True
         result.msg = "Готово"
         result.zip_data = buf
@@ -846,14 +1073,18 @@ def expire_and_add_services(zip_bytes: bytes, expire_excel: bytes, add_excel: by
     except Exception as e:
         result.add_issue(Issue(
             type=IssueType.INVALID_JSON,
-            severity="error",
+            severity=Severity.ERROR,
             message=f"Критическая ошибка: {str(e)}"
         ))
         result.msg = f"Ошибка: {e}"
+    finally:
+        if src is not None:
+            src.close()
     
     return result
 
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
 def create_replace_offer_from_excel(excel_bytes: bytes, json_name: str, json_id: str) -> SimpleResult:
     """1. Добавление перехода для одного тарифного плана."""
     result = SimpleResult(False, "", None, {})
@@ -863,18 +1094,10 @@ def create_replace_offer_from_excel(excel_bytes: bytes, json_name: str, json_id:
         result.issues.extend(read_issues)
         
         total_rows = len(df)
-        df["offer_id"] = df["offer_id"].apply(_normalize_str)
         
-        for idx, row in df.iterrows():
-            if not row["offer_id"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой offer_id",
-                    row_number=idx + 2
-                ))
+        valid = _report_empty_ids(result, df, [("offer_id", "Пустой offer_id", None)])
         
-        df = df[df["offer_id"] != ""]
+        df = df[valid].sort_values("offer_id", kind="stable")
         
         result.counts["total_rows"] = total_rows
         result.counts["valid_rows"] = len(df)
@@ -883,12 +1106,13 @@ def create_replace_offer_from_excel(excel_bytes: bytes, json_name: str, json_id:
             result.msg = "В Excel нет валидных строк"
             return result
         
-        offers = [_make_offering(_normalize_id(r["offer_id"])) for _, r in df.iterrows() if _normalize_id(r["offer_id"])]
-        pog = _build_pog_replace(_normalize_str(json_name), _normalize_id(json_id), DEFAULT_LOCALE, offers)
+        offers = [_make_offering(oid) for oid in df["offer_id"].tolist()]
+        pog = _build_pog_replace(_normalize_str(json_name), _normalize_id(json_id), DEFAULT_LOCALE, offers, pre_sorted=True)
         
         buf = io.BytesIO()
-        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-            zf.writestr(f"{POG_DIR}/{_safe_name(json_id)}.json", _json_dumps_stable(pog))
+        stamp = time.localtime()[:6]
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zf:
+            _writestr(zf, f"{POG_DIR}/{_safe_name(json_id)}.json", _json_dumps_stable(pog), stamp)
         buf.seek(0)
         
         result.counts["created_jsons"] = 1
@@ -900,7 +1124,7 @@ def create_replace_offer_from_excel(excel_bytes: bytes, json_name: str, json_id:
     except Exception as e:
         result.add_issue(Issue(
             type=IssueType.INVALID_JSON,
-            severity="error",
+            severity=Severity.ERROR,
             message=f"Критическая ошибка: {str(e)}"
         ))
         result.msg = f"Ошибка: {e}"
@@ -908,15 +1132,17 @@ def create_replace_offer_from_excel(excel_bytes: bytes, json_name: str, json_id:
     return result
 
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
 def add_offer_to_transitions(zip_bytes: bytes, excel_bytes: bytes, offer_id: str) -> SimpleResult:
     """2. Добавление нового тарифа в переходы."""
     result = SimpleResult(False, "", None, {})
+    src: Optional[zipfile.ZipFile] = None
     
     try:
-        names, blob, zip_issues = _read_zip(zip_bytes)
+        src, json_by_dir, zip_issues = _read_zip(zip_bytes)
         result.issues.extend(zip_issues)
         
-        json_files = _list_json_in_dir(blob, POG_DIR)
+        json_files = json_by_dir.get(POG_DIR, [])
         if not json_files:
             result.msg = f"В ZIP нет JSON в {POG_DIR}/"
             return result
@@ -927,29 +1153,20 @@ def add_offer_to_transitions(zip_bytes: bytes, excel_bytes: bytes, offer_id: str
         result.issues.extend(read_issues)
         
         total_rows = len(df)
-        df["json_id"] = df["json_id"].apply(_normalize_str)
         
-        for idx, row in df.iterrows():
-            if not row["json_id"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой json_id",
-                    row_number=idx + 2
-                ))
+        valid = _report_empty_ids(result, df, [("json_id", "Пустой json_id", None)])
         
-        target_ids = {x for x in df["json_id"].tolist() if x}
+        target_ids = set(df["json_id"].to_numpy()[valid].tolist())
         
         result.counts["total_rows"] = total_rows
         result.counts["valid_rows"] = len(target_ids)
         
-        updated: Dict[str, str] = {}
+        updated: Dict[str, bytes] = {}
         seen = set()
         want = _normalize_id(offer_id)
         skipped_rows: List[Dict[str, str]] = []
         
-        for path in json_files:
-            data = _load_json(blob[path], path, result.issues)
+        for path, data in _load_jsons(src, json_files, result.issues, _id_needles(target_ids)):
             if not data:
                 continue
             
@@ -959,24 +1176,16 @@ def add_offer_to_transitions(zip_bytes: bytes, excel_bytes: bytes, offer_id: str
             
             seen.add(jid)
             
-            if data.get("purpose") != ["replaceOffer"]:
-                result.add_issue(Issue(
-                    type=IssueType.INVALID_TARGET_TYPE,
-                    severity="error",
-                    message=f"Неверный purpose (ожидается replaceOffer)",
-                    file_path=path,
-                    context={"json_id": jid}
-                ))
+            if not _check_purpose(data, "replaceOffer", path, jid, result.issues):
                 continue
             
             offerings = data.get("productOfferingsInGroup", [])
-            existing = {_normalize_id(o.get("id", "")) for o in offerings}
-            
-            if want in existing:
+            # Ищем один id — множество не строим, выходим на первом совпадении
+            if any(_normalize_id(o.get("id", "")) == want for o in offerings):
                 result.add_issue(Issue(
                     type=IssueType.ALREADY_EXISTS,
-                    severity="info",
-                    message=f"Тариф уже существует",
+                    severity=Severity.INFO,
+                    message="Тариф уже существует",
                     file_path=path,
                     context={"json_id": jid, "offer_id": want}
                 ))
@@ -988,29 +1197,30 @@ def add_offer_to_transitions(zip_bytes: bytes, excel_bytes: bytes, offer_id: str
                 continue
             
             offerings.append(_make_offering(want))
-            data["productOfferingsInGroup"] = sorted(offerings, key=lambda x: x["id"])
+            offerings.sort(key=OFFERING_ID_KEY)
+            data["productOfferingsInGroup"] = offerings
             updated[path] = _json_dumps_stable(data)
         
         for want_id in target_ids:
             if want_id not in seen:
                 result.add_issue(Issue(
                     type=IssueType.NOT_FOUND_JSON_ID,
-                    severity="error",
-                    message=f"JSON файл не найден",
+                    severity=Severity.ERROR,
+                    message="JSON файл не найден",
                     context={"json_id": want_id}
                 ))
         
         result.counts["files_processed"] = len(updated)
         result.counts["added"] = len(updated)
         result.counts["skipped_existing"] = len(skipped_rows)
-        result.details = {"skipped_existing": skipped_rows}
+        result.details = {"skipped_existing": pd.DataFrame(skipped_rows)}
         
         if not updated:
             result.ok = True
             result.msg = "Нет изменений"
             return result
         
-        buf = _build_new_zip(names, blob, updated)
+        buf = _build_new_zip(src, updated)
         result.ok = True
         result.msg = "Готово"
         result.zip_data = buf
@@ -1018,23 +1228,28 @@ def add_offer_to_transitions(zip_bytes: bytes, excel_bytes: bytes, offer_id: str
     except Exception as e:
         result.add_issue(Issue(
             type=IssueType.INVALID_JSON,
-            severity="error",
+            severity=Severity.ERROR,
             message=f"Критическая ошибка: {str(e)}"
         ))
         result.msg = f"Ошибка: {e}"
+    finally:
+        if src is not None:
+            src.close()
     
     return result
 
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
 def expire_offer_in_transitions(zip_bytes: bytes, excel_bytes: bytes) -> SimpleResult:
     """3. Экспайр тарифного плана в переходах."""
     result = SimpleResult(False, "", None, {})
+    src: Optional[zipfile.ZipFile] = None
     
     try:
-        names, blob, zip_issues = _read_zip(zip_bytes)
+        src, json_by_dir, zip_issues = _read_zip(zip_bytes)
         result.issues.extend(zip_issues)
         
-        json_files = _list_json_in_dir(blob, POG_DIR)
+        json_files = json_by_dir.get(POG_DIR, [])
         if not json_files:
             result.msg = f"В ZIP нет JSON в {POG_DIR}/"
             return result
@@ -1046,37 +1261,25 @@ def expire_offer_in_transitions(zip_bytes: bytes, excel_bytes: bytes) -> SimpleR
         
         total_rows = len(df)
         
-        for c in ["json_id", "offer_id"]:
-            df[c] = df[c].apply(_normalize_str)
-        
-        for idx, row in df.iterrows():
-            if not row["json_id"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой json_id",
-                    row_number=idx + 2
-                ))
-            if not row["offer_id"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой offer_id",
-                    row_number=idx + 2
-                ))
+        valid = _report_empty_ids(result, df, [
+            ("json_id", "Пустой json_id", None),
+            ("offer_id", "Пустой offer_id", None),
+        ])
         
-        df = df[(df["json_id"] != "") & (df["offer_id"] != "")]
+        df = df[valid]
         
         result.counts["total_rows"] = total_rows
         result.counts["valid_rows"] = len(df)
         
-        expire_map = df.groupby("json_id")["offer_id"].apply(list).to_dict()
+        expire_map: Dict[str, List[str]] = defaultdict(list)
+        for jid, oid in zip(df["json_id"].tolist(), df["offer_id"].tolist()):
+            expire_map[jid].append(oid)
         
-        updated: Dict[str, str] = {}
+        updated: Dict[str, bytes] = {}
         found_ids = set()
+        already_expired = 0
         
-        for path in json_files:
-            data = _load_json(blob[path], path, result.issues)
+        for path, data in _load_jsons(src, json_files, result.issues, _id_needles(expire_map)):
             if not data:
                 continue
             
@@ -1086,28 +1289,20 @@ def expire_offer_in_transitions(zip_bytes: bytes, excel_bytes: bytes) -> SimpleR
             
             found_ids.add(jid)
             
-            if data.get("purpose") != ["replaceOffer"]:
-                result.add_issue(Issue(
-                    type=IssueType.INVALID_TARGET_TYPE,
-                    severity="error",
-                    message=f"Неверный purpose (ожидается replaceOffer)",
-                    file_path=path,
-                    context={"json_id": jid}
-                ))
+            if not _check_purpose(data, "replaceOffer", path, jid, result.issues):
                 continue
             
             offerings = data.get("productOfferingsInGroup", [])
-            index_by_id = {_normalize_id(o.get("id", "")): o for o in offerings}
+            index_by_id = _index_offerings(offerings, expire_map[jid])
             
             modified = False
             for oid in expire_map[jid]:
-                oid = _normalize_id(oid)
                 o = index_by_id.get(oid)
                 if o is None:
                     result.add_issue(Issue(
                         type=IssueType.NOT_FOUND_OFFER_ID,
-                        severity="error",
-                        message=f"Тариф не найден",
+                        severity=Severity.ERROR,
+                        message="Тариф не найден",
                         file_path=path,
                         context={"json_id": jid, "offer_id": oid}
                     ))
@@ -1117,36 +1312,38 @@ def expire_offer_in_transitions(zip_bytes: bytes, excel_bytes: bytes) -> SimpleR
                     o["expiredForSales"] = True
                     modified = True
                 else:
+                    already_expired += 1
                     result.add_issue(Issue(
                         type=IssueType.ALREADY_EXPIRED,
-                        severity="info",
-                        message=f"Тариф уже экспайрнут",
+                        severity=Severity.INFO,
+                        message="Тариф уже экспайрнут",
                         file_path=path,
                         context={"json_id": jid, "offer_id": oid}
                     ))
             
             if modified:
-                data["productOfferingsInGroup"] = sorted(offerings, key=lambda x: x["id"])
+                offerings.sort(key=OFFERING_ID_KEY)
+                data["productOfferingsInGroup"] = offerings
                 updated[path] = _json_dumps_stable(data)
         
-        for want_id in expire_map.keys():
+        for want_id in sorted(expire_map):  # порядок как у прежнего groupby
             if want_id not in found_ids:
                 result.add_issue(Issue(
                     type=IssueType.NOT_FOUND_JSON_ID,
-                    severity="error",
-                    message=f"JSON файл не найден",
+                    severity=Severity.ERROR,
+                    message="JSON файл не найден",
                     context={"json_id": want_id}
                 ))
         
         result.counts["files_processed"] = len(updated)
-        result.counts["expired"] = sum(1 for i in result.issues if i.type == IssueType.ALREADY_EXPIRED)
+        result.counts["expired"] = already_expired
         
         if not updated:
             result.ok = True
             result.msg = "Нет изменений"
             return result
         
-        buf = _build_new_zip(names, blob, updated)
+        buf = _build_new_zip(src, updated)
         result.ok = True
         result.msg = "Готово"
         result.zip_data = buf
@@ -1154,14 +1351,18 @@ def expire_offer_in_transitions(zip_bytes: bytes, excel_bytes: bytes) -> SimpleR
     except Exception as e:
         result.add_issue(Issue(
             type=IssueType.INVALID_JSON,
-            severity="error",
+            severity=Severity.ERROR,
             message=f"Критическая ошибка: {str(e)}"
         ))
         result.msg = f"Ошибка: {e}"
+    finally:
+        if src is not None:
+            src.close()
     
     return result
 
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
 def generate_categories_from_excel(excel_bytes: bytes) -> SimpleResult:
     """Категории (ProductOfferingCategory)."""
     result = SimpleResult(False, "", None, {})
@@ -1172,26 +1373,12 @@ def generate_categories_from_excel(excel_bytes: bytes) -> SimpleResult:
         
         total_rows = len(df)
         
-        for c in ["offer_id", "category_id"]:
-            df[c] = df[c].apply(_normalize_str)
-        
-        for idx, row in df.iterrows():
-            if not row["offer_id"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой offer_id",
-                    row_number=idx + 2
-                ))
-            if not row["category_id"]:
-                result.add_issue(Issue(
-                    type=IssueType.EMPTY_ID,
-                    severity="warning",
-                    message="Пустой category_id",
-                    row_number=idx + 2
-                ))
+        valid = _report_empty_ids(result, df, [
+            ("offer_id", "Пустой offer_id", None),
+            ("category_id", "Пустой category_id", None),
+        ])
         
-        df = df[(df["offer_id"] != "") & (df["category_id"] != "")]
+        df = df[valid]
         
         result.counts["total_rows"] = total_rows
         result.counts["valid_rows"] = len(df)
@@ -1200,15 +1387,18 @@ def generate_categories_from_excel(excel_bytes: bytes) -> SimpleResult:
             result.msg = "В Excel нет валидных строк"
             return result
         
-        groups = df.groupby("offer_id")["category_id"].apply(list).to_dict()
+        cat_map: Dict[str, List[str]] = defaultdict(list)
+        for oid, cid in zip(df["offer_id"].tolist(), df["category_id"].tolist()):
+            cat_map[oid].append(cid)
         buf = io.BytesIO()
         created = 0
         added = 0
         
-        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-            for offer_id, cats in groups.items():
-                cat_json = _build_category(_normalize_id(offer_id), [_normalize_id(x) for x in cats])
-                zf.writestr(f"{POC_DIR}/{_safe_name(offer_id)}.json", _json_dumps_stable(cat_json))
+        stamp = time.localtime()[:6]
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zf:
+            for offer_id in sorted(cat_map):  # порядок как у прежнего groupby
+                cat_json = _build_category(offer_id, cat_map[offer_id])
+                _writestr(zf, f"{POC_DIR}/{_safe_name(offer_id)}.json", _json_dumps_stable(cat_json), stamp)
                 created += 1
                 added += len(cat_json["category"])
         
@@ -1222,7 +1412,7 @@ def generate_categories_from_excel(excel_bytes: bytes) -> SimpleResult:
     except Exception as e:
         result.add_issue(Issue(
             type=IssueType.INVALID_JSON,
-            severity="error",
+            severity=Severity.ERROR,
             message=f"Критическая ошибка: {str(e)}"
         ))
         result.msg = f"Ошибка: {e}"
@@ -1233,30 +1423,34 @@ def generate_categories_from_excel(excel_bytes: bytes) -> SimpleResult:
 # =========================
 # UI ФУНКЦИИ
 # =========================
+def _csv_bytes(df: pd.DataFrame) -> bytes:
+    """CSV с BOM (для Excel) сразу в байтах — без промежуточной строки"""
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, encoding="utf-8-sig")
+    return buf.getvalue()
+
+
 def _show_counts(counts: Dict[str, int]):
     if not counts:
         return
-    items = list(counts.items())
-    for i in range(0, len(items), 4):
-        cols = st.columns(4)
-        for j, (k, v) in enumerate(items[i:i+4]):
-            with cols[j]:
-                st.metric(k, v)
+    # Один набор колонок: метрика i уходит в колонку i % 4, сетка выглядит так же,
+    # но без st.columns на каждую строку
+    cols = st.columns(COUNTS_PER_ROW)
+    for i, (k, v) in enumerate(counts.items()):
+        cols[i % COUNTS_PER_ROW].metric(k, v)
 
 
 def _show_skipped_details(details: Optional[Dict[str, Any]], filename: str = "skipped_details.csv"):
-    rows = (details or {}).get("skipped_existing") or []
-    with st.expander(f"Детали пропусков (skipped_existing): {len(rows)}", expanded=False):
-        if not rows:
+    # Таблица собрана в самой операции и приходит из кэша — без пересборки на каждый rerun
+    df = (details or {}).get("skipped_existing", EMPTY_FRAME)
+    with st.expander(f"Детали пропусков (skipped_existing): {len(df)}", expanded=False):
+        if df.empty:
             st.caption("Нет пропусков.")
             return
-        df = pd.DataFrame(rows)
         st.dataframe(df, use_container_width=True, height=320)
-        csv_buf = io.StringIO()
-        df.to_csv(csv_buf, index=False)
         st.download_button(
             "Скачать детали (CSV)",
-            csv_buf.getvalue().encode("utf-8-sig"),
+            _csv_bytes(df),
             file_name=filename,
             mime="text/csv",
         )
@@ -1268,9 +1462,9 @@ def _show_all_issues(issues: List[Issue]):
         st.success("✅ Ошибок и предупреждений нет")
         return
     
-    errors = [i for i in issues if i.severity == "error"]
-    warnings = [i for i in issues if i.severity == "warning"]
-    infos = [i for i in issues if i.severity == "info"]
+    errors = [i for i in issues if i.severity == Severity.ERROR]
+    warnings = [i for i in issues if i.severity == Severity.WARNING]
+    infos = [i for i in issues if i.severity == Severity.INFO]
     
     # Краткая сводка
     col1, col2, col3 = st.columns(3)
@@ -1301,23 +1495,26 @@ def _show_all_issues(issues: List[Issue]):
     _export_all_issues_csv(issues)
 
 
+def _issues_frame(issues: List[Issue], base_cols: List[str],
+                  base_values: Callable[[Issue], Tuple], ctx_prefix: str = "") -> pd.DataFrame:
+    """Таблица проблем: схема (базовые столбцы + ключи context в порядке появления)
+    собирается один раз, строки — кортежами через DataFrame.from_records"""
+    ctx_keys = list(dict.fromkeys(k for issue in issues if issue.context for k in issue.context))
+    records = []
+    for issue in issues:
+        ctx = issue.context
+        records.append(base_values(issue) + tuple(str(ctx[k]) if k in ctx else None for k in ctx_keys))
+    return pd.DataFrame.from_records(records, columns=base_cols + [f"{ctx_prefix}{k}" for k in ctx_keys])
+
+
 def _show_issues_table(issues: List[Issue]):
     """Таблица проблем"""
-    data = []
-    for issue in issues:
-        row = {
-            "Тип": issue.type.value,
-            "Сообщение": issue.message,
-            "Файл": issue.file_path or "-",
-            "Строка": issue.row_number or "-",
-        }
-        if issue.context:
-            for k, v in issue.context.items():
-                row[k] = str(v)
-        data.append(row)
-    
-    if data:
-        df = pd.DataFrame(data)
+    if issues:
+        df = _issues_frame(
+            issues,
+            ["Тип", "Сообщение", "Файл", "Строка"],
+            lambda i: (i.type, i.message, i.file_path or "-", i.row_number or "-"),
+        )
         st.dataframe(df, use_container_width=True, height=min(400, len(df) * 35 + 38))
 
 
@@ -1326,32 +1523,70 @@ def _export_all_issues_csv(issues: List[Issue]):
     if not issues:
         return
     
-    data = []
-    for issue in issues:
-        row = {
-            "severity": issue.severity,
-            "type": issue.type.value,
-            "message": issue.message,
-            "file_path": issue.file_path or "",
-            "row_number": issue.row_number or "",
-        }
-        if issue.context:
-            for k, v in issue.context.items():
-                row[f"context_{k}"] = str(v)
-        data.append(row)
-    
-    df = pd.DataFrame(data)
-    csv_buf = io.StringIO()
-    df.to_csv(csv_buf, index=False)
-    
+    df = _issues_frame(
+        issues,
+        ["severity", "type", "message", "file_path", "row_number"],
+        lambda i: (i.severity, i.type, i.message, i.file_path or "", i.row_number or ""),
+        ctx_prefix="context_",
+    )
     st.download_button(
         "Скачать полный отчет (CSV)",
-        csv_buf.getvalue().encode("utf-8-sig"),
+        _csv_bytes(df),
         file_name="full_issues_report.csv",
         mime="text/csv",
     )
 
 
+@dataclass(frozen=True)
+class ScenarioSpec:
+    """Типовой сценарий: загрузки (+ текстовые поля) → операция → результат"""
+    title: str
+    info: str
+    func: Callable[..., SimpleResult]
+    uploads: Tuple[Tuple[str, Tuple[str, ...]], ...]  # (подпись, типы); порядок = порядок аргументов func
+    missing_msg: str
+    output_name: str
+    texts: Tuple[Tuple[str, Optional[str]], ...] = ()  # (подпись, placeholder); аргументы func после файлов
+    skipped_csv: Optional[str] = None
+
+
+def _show_result(res: SimpleResult, output_name: str, skipped_csv: Optional[str] = None):
+    if not res.ok:
+        st.error(res.msg)
+    else:
+        st.success(res.msg)
+        _show_counts(res.counts)
+        if skipped_csv:
+            _show_skipped_details(res.details, filename=skipped_csv)
+        if res.zip_data:
+            st.download_button("Скачать ZIP", res.zip_data, output_name, "application/zip")
+    
+    # Показываем все проблемы
+    if res.issues:
+        st.markdown("---")
+        _show_all_issues(res.issues)
+
+
+def _run_scenario(spec: ScenarioSpec):
+    st.subheader(spec.title)
+    st.info(spec.info)
+    files = [st.file_uploader(label, type=list(types)) for label, types in spec.uploads]
+    if len(spec.texts) > 1:
+        texts = []
+        for col, (label, placeholder) in zip(st.columns(len(spec.texts)), spec.texts):
+            with col:
+                texts.append(st.text_input(label, placeholder=placeholder))
+    else:
+        texts = [st.text_input(label, placeholder=placeholder) for label, placeholder in spec.texts]
+    if st.button("Выполнить"):
+        if not all(files) or not all(texts):
+            st.error(spec.missing_msg)
+        else:
+            with st.spinner("Обработка..."):
+                res = spec.func(*(f.read() for f in files), *texts)
+            _show_result(res, spec.output_name, spec.skipped_csv)
+
+
 # =========================
 # STREAMLIT UI
 # =========================
@@ -1363,92 +1598,84 @@ st.caption("Управление услугами (AddOns), переходами
 st.sidebar.title("Навигация")
 main_section = st.sidebar.radio("Выберите раздел:", ["Услуги (AddOns)", "Переходы тарифных планов", "Категории"])
 
+SERVICE_SCENARIOS: Dict[str, Optional[ScenarioSpec]] = {
+    "1. Доступность услуги для некоторых тарифных планов": ScenarioSpec(
+        "Доступность услуги для некоторых тарифных планов",
+        "Excel/CSV должен содержать столбцы: Addons name, Addons ID, Имя услуги, ID услуги",
+        generate_addon_from_excel,
+        (("Загрузите Excel/CSV", EXCEL_TYPES),),
+        "Загрузите Excel/CSV",
+        "addons.zip",
+    ),
+    "2. Добавление услуги в существующие планы": ScenarioSpec(
+        "Добавление услуги в существующие планы",
+        "Excel/CSV должен содержать столбцы: Addons ID, Имя услуги, ID услуги",
+        add_services_to_existing_pogs,
+        (("Загрузите ZIP с планами", ZIP_TYPES), ("Загрузите Excel/CSV с услугами", EXCEL_TYPES)),
+        "Загрузите ZIP и Excel/CSV",
+        "updated_addons.zip",
+        skipped_csv="skipped_services_existing.csv",
+    ),
+    "3. Экспайр услуги": ScenarioSpec(
+        "Экспайр услуги",
+        "Excel/CSV должен содержать столбцы: json_id, service_id",
+        expire_services_in_pogs,
+        (("Загрузите ZIP с планами", ZIP_TYPES), ("Загрузите Excel/CSV со списком к экспайру", EXCEL_TYPES)),
+        "Загрузите ZIP и Excel/CSV",
+        "expired_addons.zip",
+    ),
+    "4. Экспайр + Добавление услуги": None,
+}
+
+TRANSITION_SCENARIOS: Dict[str, ScenarioSpec] = {
+    "1. Создать переход для одного тарифного плана": ScenarioSpec(
+        "Создать новый переход",
+        "Excel/CSV должен содержать столбец: offer_id",
+        create_replace_offer_from_excel,
+        (("Загрузите Excel/CSV с offer_id", EXCEL_TYPES),),
+        "Заполните все поля и загрузите Excel/CSV",
+        "replace_offer.zip",
+        texts=(("Название перехода", "Replace for ..."), ("ID перехода", None)),
+    ),
+    "2. Добавить тариф в переходы": ScenarioSpec(
+        "Добавить тариф в переходы",
+        "Excel/CSV должен содержать столбец: json_id (ID перехода)",
+        add_offer_to_transitions,
+        (("Загрузите ZIP с переходами", ZIP_TYPES), ("Загрузите Excel/CSV со списком переходов", EXCEL_TYPES)),
+        "Заполните все поля и загрузите файлы",
+        "updated_replace_offers.zip",
+        texts=(("ID тарифного плана (offer_id)", None),),
+        skipped_csv="skipped_offers_existing.csv",
+    ),
+    "3. Экспайр тарифа в переходах": ScenarioSpec(
+        "Экспайр тарифа в переходах",
+        "Excel/CSV должен содержать столбцы: json_id, offer_id",
+        expire_offer_in_transitions,
+        (("Загрузите ZIP с переходами", ZIP_TYPES), ("Загрузите Excel/CSV", EXCEL_TYPES)),
+        "Загрузите ZIP и Excel/CSV",
+        "expired_replace_offers.zip",
+    ),
+}
+
+CATEGORY_SCENARIO = ScenarioSpec(
+    "Сгенерировать категории из Excel/CSV",
+    "Excel/CSV должен содержать столбцы: offer_id, category_id (несколько строк на один offer_id объединяются)",
+    generate_categories_from_excel,
+    (("Загрузите Excel/CSV", EXCEL_TYPES),),
+    "Загрузите Excel/CSV",
+    "categories.zip",
+)
+
 # --------- Раздел 1: Услуги ----------
 if main_section == "Услуги (AddOns)":
     st.header("Работа с услугами")
-    scenario = st.radio(
-        "Выберите операцию:",
-        [
-            "1. Доступность услуги для некоторых тарифных планов",
-            "2. Добавление услуги в существующие планы",
-            "3. Экспайр услуги",
-            "4. Экспайр + Добавление услуги"
-        ]
-    )
-
-    if scenario.startswith("1."):
-        st.subheader("Доступность услуги для некоторых тарифных планов")
-        st.info("Excel/CSV должен содержать столбцы: Addons name, Addons ID, Имя услуги, ID услуги")
-        excel_file = st.file_uploader("Загрузите Excel/CSV", type=["xlsx", "xls", "csv"])
-        if st.button("Выполнить"):
-            if not excel_file:
-                st.error("Загрузите Excel/CSV")
-            else:
-                with st.spinner("Обработка..."):
-                    res = generate_addon_from_excel(excel_file.read())
-                if not res.ok:
-                    st.error(res.msg)
-                else:
-                    st.success(res.msg)
-                    _show_counts(res.counts)
-                    if res.zip_data:
-                        st.download_button("Скачать ZIP", res.zip_data, "addons.zip", "application/zip")
-                
-                # Показываем все проблемы
-                if res.issues:
-                    st.markdown("---")
-                    _show_all_issues(res.issues)
+    scenario = st.radio("Выберите операцию:", list(SERVICE_SCENARIOS))
+    spec = SERVICE_SCENARIOS[scenario]
 
-    elif scenario.startswith("2."):
-        st.subheader("Добавление услуги в существующие планы")
-        st.info("Excel/CSV должен содержать столбцы: Addons ID, Имя услуги, ID услуги")
-        zip_file = st.file_uploader("Загрузите ZIP с планами", type=["zip"])
-        excel_file = st.file_uploader("Загрузите Excel/CSV с услугами", type=["xlsx", "xls", "csv"])
-        if st.button("Выполнить"):
-            if not zip_file or not excel_file:
-                st.error("Загрузите ZIP и Excel/CSV")
-            else:
-                with st.spinner("Обработка..."):
-                    res = add_services_to_existing_pogs(zip_file.read(), excel_file.read())
-                if not res.ok:
-                    st.error(res.msg)
-                else:
-                    st.success(res.msg)
-                    _show_counts(res.counts)
-                    _show_skipped_details(res.details, filename="skipped_services_existing.csv")
-                    if res.zip_data:
-                        st.download_button("Скачать ZIP", res.zip_data, "updated_addons.zip", "application/zip")
-                
-                # Показываем все проблемы
-                if res.issues:
-                    st.markdown("---")
-                    _show_all_issues(res.issues)
+    if spec is not None:
+        _run_scenario(spec)
 
-    elif scenario.startswith("3."):
-        st.subheader("Экспайр услуги")
-        st.info("Excel/CSV должен содержать столбцы: json_id, service_id")
-        zip_file = st.file_uploader("Загрузите ZIP с планами", type=["zip"])
-        excel_file = st.file_uploader("Загрузите Excel/CSV со списком к экспайру", type=["xlsx", "xls", "csv"])
-        if st.button("Выполнить"):
-            if not zip_file or not excel_file:
-                st.error("Загрузите ZIP и Excel/CSV")
-            else:
-                with st.spinner("Обработка..."):
-                    res = expire_services_in_pogs(zip_file.read(), excel_file.read())
-                if not res.ok:
-                    st.error(res.msg)
-                else:
-                    st.success(res.msg)
-                    _show_counts(res.counts)
-                    if res.zip_data:
-                        st.download_button("Скачать ZIP", res.zip_data, "expired_addons.zip", "application/zip")
-                
-                # Показываем все проблемы
-                if res.issues:
-                    st.markdown("---")
-                    _show_all_issues(res.issues)
-
-    else:  # 4. Экспайр + Добавление услуги
+    else:  # 4. Экспайр + Добавление услуги — своя разметка
         st.subheader("Экспайр + Добавление услуги")
         st.info("""
         **Две независимые операции:**
@@ -1462,10 +1689,10 @@ if main_section == "Услуги (AddOns)":
         
         with col1:
             st.markdown("##### 📁 Файлы для экспайра")
-            zip_file = st.file_uploader("Загрузите ZIP с планами", type=["zip"], key="expire_add_zip")
+            zip_file = st.file_uploader("Загрузите ZIP с планами", type=ZIP_TYPES, key="expire_add_zip")
             expire_file = st.file_uploader(
                 "Excel/CSV со списком услуг для экспайра",
-                type=["xlsx", "xls", "csv"],
+                type=EXCEL_TYPES,
                 key="expire_file"
             )
         
@@ -1475,7 +1702,7 @@ if main_section == "Услуги (AddOns)":
             st.write("")
             add_file = st.file_uploader(
                 "Excel/CSV со списком услуг для добавления",
-                type=["xlsx", "xls", "csv"],
+                type=EXCEL_TYPES,
                 key="add_file"
             )
         
@@ -1500,18 +1727,16 @@ if main_section == "Услуги (AddOns)":
                     if res.details:
                         col1, col2 = st.columns(2)
                         with col1:
-                            expire_skipped = res.details.get("skipped_expire_not_found", [])
+                            expire_skipped = res.details.get("skipped_expire_not_found", EMPTY_FRAME)
                             with st.expander(f"❌ Не найдено для экспайра: {len(expire_skipped)}", expanded=False):
-                                if expire_skipped:
-                                    df = pd.DataFrame(expire_skipped)
-                                    st.dataframe(df, use_container_width=True)
+                                if not expire_skipped.empty:
+                                    st.dataframe(expire_skipped, use_container_width=True)
                         
                         with col2:
-                            add_skipped = res.details.get("skipped_add_existing", [])
+                            add_skipped = res.details.get("skipped_add_existing", EMPTY_FRAME)
                             with st.expander(f"⚠️ Уже существуют: {len(add_skipped)}", expanded=False):
-                                if add_skipped:
-                                    df = pd.DataFrame(add_skipped)
-                                    st.dataframe(df, use_container_width=True)
+                                if not add_skipped.empty:
+                                    st.dataframe(add_skipped, use_container_width=True)
                     
                     if res.zip_data:
                         st.download_button(
@@ -1529,114 +1754,10 @@ if main_section == "Услуги (AddOns)":
 # --------- Раздел 2: Переходы ----------
 elif main_section == "Переходы тарифных планов":
     st.header("Работа с переходами (replaceOffer)")
-    scenario = st.radio(
-        "Выберите операцию:",
-        [
-            "1. Создать переход для одного тарифного плана",
-            "2. Добавить тариф в переходы",
-            "3. Экспайр тарифа в переходах"
-        ]
-    )
-
-    if scenario.startswith("1."):
-        st.subheader("Создать новый переход")
-        st.info("Excel/CSV должен содержать столбец: offer_id")
-        excel_file = st.file_uploader("Загрузите Excel/CSV с offer_id", type=["xlsx", "xls", "csv"])
-        col1, col2 = st.columns(2)
-        with col1:
-            json_name = st.text_input("Название перехода", placeholder="Replace for ...")
-        with col2:
-            json_id = st.text_input("ID перехода")
-        if st.button("Выполнить"):
-            if not excel_file or not json_name or not json_id:
-                st.error("Заполните все поля и загрузите Excel/CSV")
-            else:
-                with st.spinner("Обработка..."):
-                    res = create_replace_offer_from_excel(excel_file.read(), json_name, json_id)
-                if not res.ok:
-                    st.error(res.msg)
-                else:
-                    st.success(res.msg)
-                    _show_counts(res.counts)
-                    if res.zip_data:
-                        st.download_button("Скачать ZIP", res.zip_data, "replace_offer.zip", "application/zip")
-                
-                # Показываем все проблемы
-                if res.issues:
-                    st.markdown("---")
-                    _show_all_issues(res.issues)
-
-    elif scenario.startswith("2."):
-        st.subheader("Добавить тариф в переходы")
-        st.info("Excel/CSV должен содержать столбец: json_id (ID перехода)")
-        zip_file = st.file_uploader("Загрузите ZIP с переходами", type=["zip"])
-        excel_file = st.file_uploader("Загрузите Excel/CSV со списком переходов", type=["xlsx", "xls", "csv"])
-        offer_id = st.text_input("ID тарифного плана (offer_id)")
-        if st.button("Выполнить"):
-            if not zip_file or not excel_file or not offer_id:
-                st.error("Заполните все поля и загрузите файлы")
-            else:
-                with st.spinner("Обработка..."):
-                    res = add_offer_to_transitions(zip_file.read(), excel_file.read(), offer_id)
-                if not res.ok:
-                    st.error(res.msg)
-                else:
-                    st.success(res.msg)
-                    _show_counts(res.counts)
-                    _show_skipped_details(res.details, filename="skipped_offers_existing.csv")
-                    if res.zip_data:
-                        st.download_button("Скачать ZIP", res.zip_data, "updated_replace_offers.zip", "application/zip")
-                
-                # Показываем все проблемы
-                if res.issues:
-                    st.markdown("---")
-                    _show_all_issues(res.issues)
-
-    else:
-        st.subheader("Экспайр тарифа в переходах")
-        st.info("Excel/CSV должен содержать столбцы: json_id, offer_id")
-        zip_file = st.file_uploader("Загрузите ZIP с переходами", type=["zip"])
-        excel_file = st.file_uploader("Загрузите Excel/CSV", type=["xlsx", "xls", "csv"])
-        if st.button("Выполнить"):
-            if not zip_file or not excel_file:
-                st.error("Загрузите ZIP и Excel/CSV")
-            else:
-                with st.spinner("Обработка..."):
-                    res = expire_offer_in_transitions(zip_file.read(), excel_file.read())
-                if not res.ok:
-                    st.error(res.msg)
-                else:
-                    st.success(res.msg)
-                    _show_counts(res.counts)
-                    if res.zip_data:
-                        st.download_button("Скачать ZIP", res.zip_data, "expired_replace_offers.zip", "application/zip")
-                
-                # Показываем все проблемы
-                if res.issues:
-                    st.markdown("---")
-                    _show_all_issues(res.issues)
+    scenario = st.radio("Выберите операцию:", list(TRANSITION_SCENARIOS))
+    _run_scenario(TRANSITION_SCENARIOS[scenario])
 
 # --------- Раздел 3: Категории ----------
 else:
     st.header("Категории (ProductOfferingCategory)")
-    st.subheader("Сгенерировать категории из Excel/CSV")
-    st.info("Excel/CSV должен содержать столбцы: offer_id, category_id (несколько строк на один offer_id объединяются)")
-    excel_file = st.file_uploader("Загрузите Excel/CSV", type=["xlsx", "xls", "csv"])
-    if st.button("Выполнить"):
-        if not excel_file:
-            st.error("Загрузите Excel/CSV")
-        else:
-            with st.spinner("Обработка..."):
-                res = generate_categories_from_excel(excel_file.read())
-            if not res.ok:
-                st.error(res.msg)
-            else:
-                st.success(res.msg)
-                _show_counts(res.counts)
-                if res.zip_data:
-                    st.download_button("Скачать ZIP", res.zip_data, "categories.zip", "application/zip")
-            
-            # Показываем все проблемы
-            if res.issues:
-                st.markdown("---")
-                _show_all_issues(res.issues)
+    _run_scenario(CATEGORY_SCENARIO)